@@ -1,183 +1,504 @@
-import os
-import faiss
-import json
-import requests
-import numpy as np
-from sentence_transformers import SentenceTransformer
-
-# ---------------- CONFIG ----------------
-TEXT_DIR = r"C:\Users\revan\Downloads\InfosysSpringboard\output"
-EMBED_MODEL = "all-MiniLM-L6-v2"
-OLLAMA_MODEL = "gemma:2b"
-TOP_K = 6
-MAX_CONTEXT_WORDS = 400
-OLLAMA_URL = "http://localhost:11434/api/generate"
-TIMEOUT = 600
-# ---------------------------------------
-
-
-# 1️⃣ Load documents safely
-documents = []
-
-if not os.path.exists(TEXT_DIR):
-    raise FileNotFoundError(f"TEXT_DIR not found: {TEXT_DIR}")
-
-for file in os.listdir(TEXT_DIR):
-    if file.endswith(".txt"):
-        with open(os.path.join(TEXT_DIR, file), "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read().strip()
-            if text:
-                documents.append(text)
-
-print(f"Loaded {len(documents)} lease documents")
-
-if not documents:
-    raise ValueError("No text files found or all files are empty")
-
-
-# 2️⃣ Chunking
-def chunk_text(text, chunk_size=120):
-    words = text.split()
-    return [
-        " ".join(words[i:i + chunk_size])
-        for i in range(0, len(words), chunk_size)
-        if len(words[i:i + chunk_size]) > 20
-    ]
-
-
-chunks = []
-for doc in documents:
-    chunks.extend(chunk_text(doc))
-
-print(f"Created {len(chunks)} text chunks")
-
-if not chunks:
-    raise ValueError("Chunking failed — no chunks created")
-
-
-# 3️⃣ FAISS embeddings (FIX: float32)
-embedder = SentenceTransformer(EMBED_MODEL)
-
-embeddings = embedder.encode(
-    chunks,
-    convert_to_numpy=True,
-    normalize_embeddings=True
-).astype(np.float32)
-
-index = faiss.IndexFlatL2(embeddings.shape[1])
-index.add(embeddings)
-
-print("FAISS index built")
-
-
-# 4️⃣ Query (FIX: float32 + correct shape)
-query = "lease payment fees penalties early termination mileage insurance"
-
-query_embedding = embedder.encode(
-    [query],
-    convert_to_numpy=True,
-    normalize_embeddings=True
-).astype(np.float32)
-
-_, indices = index.search(query_embedding, TOP_K)
-
-
-# 5️⃣ Filter useful chunks
-KEYWORDS = [
-    "payment", "fee", "penalty", "termination",
-    "mileage", "insurance", "cost", "deposit"
-]
-
-context_chunks = []
-word_count = 0
-
-for i in indices[0]:
-    chunk = chunks[i]
-    if any(k in chunk.lower() for k in KEYWORDS):
-        words = chunk.split()
-        if word_count + len(words) > MAX_CONTEXT_WORDS:
-            break
-        context_chunks.append(chunk)
-        word_count += len(words)
-
-context = "\n\n".join(context_chunks)
-
-if not context.strip():
-    raise ValueError("❌ No relevant lease clauses found")
-
-print("\n--- CONTEXT SENT TO OLLAMA ---")
-print(context[:1000])
-print("--------------------------------")
-
-
-# 6️⃣ Prompt
-prompt = f"""
-You are a professional car lease negotiation expert.
-
-Using ONLY the lease clauses below:
-1. Identify negotiable fees, deposits, mileage limits, penalties
-2. Explain how customers can negotiate each item
-3. Provide example negotiation phrases customers can say
-
-Lease clauses:
-{context}
-
-Respond with a JSON object in the following format:
-{{
-  "negotiable_items": [
-    {{
-      "item": "fee name",
-      "description": "brief description",
-      "negotiation_tips": "how to negotiate",
-      "example_phrase": "example phrase"
-    }}
-  ],
-  "summary": "overall summary"
-}}
-"""
-
-
-# 7️⃣ Ollama call
-print("\nGenerating negotiation advice...\n")
-
-try:
-    response = requests.post(
-        OLLAMA_URL,
-        json={
-            "model": OLLAMA_MODEL,
-            "prompt": prompt,
-            "stream": False,
-            "options": {"num_predict": 500}
-        },
-        timeout=TIMEOUT
-    )
-except requests.exceptions.ConnectionError:
-    raise RuntimeError("❌ Ollama is not running. Start it using: ollama serve")
-
-if response.status_code != 200:
-    print(f"Error: {response.status_code}")
-    print(response.text)
-    exit()
-
-data = response.json()
-result = data.get("response", "")
-
-if len(result.strip()) < 10:
-    print("\n⚠️ Weak output from Ollama")
-    print("Raw result:", repr(result))
-else:
-    try:
-        parsed = json.loads(result)
-        print("Parsed JSON:")
-        print(json.dumps(parsed, indent=2))
-    except json.JSONDecodeError as e:
-        print(f"\n❌ Failed to parse JSON: {e}")
-        print("Raw result:")
-        print(result)
-
-
-# 8️⃣ Final output
-print("\n\n" + "=" * 60)
-print("NEGOTIATION ADVICE (GEMMA)")
-print("=" * 60)
-# The JSON is already printed above
+import os
+import re
+import math
+import faiss
+import json
+import shelve
+import hashlib
+import functools
+import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+torch.set_num_threads(os.cpu_count())
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+try:
+    # Prebuilt faiss-cpu wheels ship an AVX2 build; a wheel without it is
+    # up to 3x slower on flat search. Warn instead of failing.
+    from faiss import swigfaiss_avx2  # noqa: F401
+except ImportError:
+    print("⚠️ faiss has no AVX2 support — searches may be ~3x slower. "
+          "Install the prebuilt faiss-cpu wheel.")
+
+# ---------------- CONFIG ----------------
+TEXT_DIR = r"C:\Users\revan\Downloads\InfosysSpringboard\output"
+EMBED_MODEL = "all-MiniLM-L6-v2"
+OLLAMA_MODEL = "gemma:2b"
+TOP_K = 6
+MAX_CONTEXT_WORDS = 400
+OLLAMA_URL = "http://localhost:11434/api/generate"
+TIMEOUT = 600
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache")
+EMBED_CACHE = os.path.join(CACHE_DIR, "lease_embed.db")
+ONNX_MODEL_DIR = "onnx_minilm_int8"
+QUERY = "lease payment fees penalties early termination mileage insurance"
+# ---------------------------------------
+
+
+# 1️⃣ Document loading
+def iter_docs():
+    """Yield lease texts one at a time so the full corpus never sits in RAM."""
+    for entry in os.scandir(TEXT_DIR):
+        if entry.name.endswith(".txt"):
+            with open(entry.path, "rb") as f:
+                text = f.read().decode("utf-8", errors="ignore").strip()
+            if text:
+                yield text
+
+
+# 2️⃣ Chunking
+def chunk_text(text, chunk_size=120):
+    # Single slice per chunk; the old version sliced twice (filter + join)
+    # and re-measured each slice. The tail check n - i > 20 is equivalent.
+    words = text.split()
+    n = len(words)
+    return [
+        " ".join(words[i:i + chunk_size])
+        for i in range(0, n, chunk_size)
+        if n - i > 20
+    ]
+
+
+def dedupe_chunks(chunks):
+    """Drop near-duplicate chunks before encoding.
+
+    Lease corpora repeat large boilerplate clauses; a MinHash-LSH pass
+    over 3-word shingles removes near-duplicates cheaply, cutting encode
+    time and index size. Falls back to exact dedup without datasketch.
+    """
+    try:
+        from datasketch import MinHash, MinHashLSH
+    except ImportError:
+        return list(dict.fromkeys(chunks))
+
+    lsh = MinHashLSH(threshold=0.9, num_perm=64)
+    unique = []
+    for n, chunk in enumerate(chunks):
+        words = chunk.split()
+        mh = MinHash(num_perm=64)
+        for i in range(max(1, len(words) - 2)):
+            mh.update(" ".join(words[i:i + 3]).encode("utf-8"))
+        if lsh.query(mh):
+            continue
+        lsh.insert(str(n), mh)
+        unique.append(chunk)
+    return unique
+
+
+# 3️⃣ Embedder (one per process, loaded lazily)
+class OnnxEmbedder:
+    """Drop-in encode() replacement backed by an INT8 ONNX export.
+
+    One-time export:
+        optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 onnx_minilm/
+    then dynamic-quantize with optimum.onnxruntime.ORTQuantizer
+    (AutoQuantizationConfig.avx512_vnni(is_static=False)) into ONNX_MODEL_DIR.
+    """
+
+    def __init__(self, model_dir):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def encode(self, sentences, batch_size=64, convert_to_numpy=True,
+               normalize_embeddings=True, show_progress_bar=False):
+        vectors = []
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start:start + batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors="pt")
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).float()
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            vectors.append(pooled.numpy())
+        embeddings = np.vstack(vectors).astype(np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+_embedder = None
+
+
+def get_embedder():
+    """Return the process-wide embedder, loading it on first use.
+
+    Importers (the Flask/Streamlit layers) share one encoder instead of
+    paying the model load on every request.
+    """
+    global _embedder
+    if _embedder is None:
+        if os.path.isdir(ONNX_MODEL_DIR):
+            print("Using INT8 ONNX embedder")
+            _embedder = OnnxEmbedder(ONNX_MODEL_DIR)
+        else:
+            _embedder = SentenceTransformer(EMBED_MODEL, device=DEVICE)
+    return _embedder
+
+
+# 4️⃣ Embedding cache + FAISS index
+def build_index(embeddings):
+    """Build a FAISS index over normalized embeddings.
+
+    Small chunk sets get an exact inner-product scan over fp16-stored
+    vectors (half the memory bandwidth of flat fp32, same ranking on unit
+    vectors). Above ~10K vectors, switch to IVF-PQ so search only scans a
+    few Voronoi cells instead of the whole database.
+    """
+    n, d = embeddings.shape
+    # FAISS takes float32 input and quantizes internally
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if n < 10_000:
+        index = faiss.IndexScalarQuantizer(
+            d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(embeddings)
+    else:
+        nlist = max(4, int(4 * math.sqrt(n)))
+        index = faiss.index_factory(d, f"IVF{nlist},PQ16x8", faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+        index.nprobe = 8
+    index.add(embeddings)
+    return index
+
+
+def _chunk_hash(chunk):
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _embed_cached(embedder, chunks):
+    """Encode chunks, reusing vectors cached on disk by content hash.
+
+    Only chunks missing from the cache are sent to the encoder, so
+    repeated runs (and overlapping documents) pay near-zero encode cost.
+    Vectors are held and persisted as float16 — ample precision for
+    normalized cosine retrieval at half the bytes.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    vectors = [None] * len(chunks)
+    missing = []
+
+    with shelve.open(EMBED_CACHE) as store:
+        for i, chunk in enumerate(chunks):
+            key = f"{EMBED_MODEL}:{_chunk_hash(chunk)}"
+            raw = store.get(key)
+            if raw is not None:
+                vectors[i] = np.frombuffer(raw, dtype=np.float16)
+            else:
+                missing.append(i)
+
+        if missing:
+            fresh = embedder.encode(
+                [chunks[i] for i in missing],
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            ).astype(np.float16)
+            for pos, i in enumerate(missing):
+                vectors[i] = fresh[pos]
+                store[f"{EMBED_MODEL}:{_chunk_hash(chunks[i])}"] = fresh[pos].tobytes()
+
+    return np.vstack(vectors)
+
+
+def _load_or_build_index(embeddings, chunks):
+    """Reload a persisted FAISS index when the chunk set is unchanged.
+
+    The index is memory-mapped read-only, so startup doesn't copy the
+    whole vector store into RSS — the OS page cache pulls in only the
+    cells a search actually touches.
+    """
+    corpus_hash = hashlib.blake2b(
+        "".join(map(_chunk_hash, chunks)).encode(), digest_size=16
+    ).hexdigest()
+    index_path = os.path.join(CACHE_DIR, f"lease_faiss_{corpus_hash}.index")
+    if os.path.exists(index_path):
+        return faiss.read_index(
+            index_path, faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP
+        )
+    index = build_index(embeddings)
+    faiss.write_index(index, index_path)
+    return index
+
+
+# 5️⃣ Keyword filter
+KEYWORDS = [
+    "payment", "fee", "penalty", "termination",
+    "mileage", "insurance", "cost", "deposit"
+]
+
+try:
+    # Aho-Corasick matches every keyword in one linear pass over the chunk
+    import ahocorasick
+
+    _KW_AUTOMATON = ahocorasick.Automaton()
+    for k in KEYWORDS:
+        _KW_AUTOMATON.add_word(k, k)
+    _KW_AUTOMATON.make_automaton()
+
+    def has_keyword(chunk):
+        return next(_KW_AUTOMATON.iter(chunk.lower()), None) is not None
+except ImportError:
+    # Compiled alternation: one C-level scan, no .lower() copy per chunk
+    _KW_RE = re.compile("|".join(KEYWORDS), re.IGNORECASE)
+
+    def has_keyword(chunk):
+        return _KW_RE.search(chunk) is not None
+
+
+def select_context(chunks, indices):
+    """Assemble the context window from retrieved chunks, capped by words."""
+    context_chunks = []
+    word_count = 0
+
+    for i in indices[0]:
+        chunk = chunks[i]
+        if has_keyword(chunk):
+            words = chunk.split()
+            if word_count + len(words) > MAX_CONTEXT_WORDS:
+                break
+            context_chunks.append(chunk)
+            word_count += len(words)
+
+    return "\n\n".join(context_chunks)
+
+
+# 6️⃣ Prompt + Ollama
+def build_prompt(context):
+    return f"""
+You are a professional car lease negotiation expert.
+
+Using ONLY the lease clauses below:
+1. Identify negotiable fees, deposits, mileage limits, penalties
+2. Explain how customers can negotiate each item
+3. Provide example negotiation phrases customers can say
+
+Lease clauses:
+{context}
+
+Respond with a JSON object in the following format:
+{{
+  "negotiable_items": [
+    {{
+      "item": "fee name",
+      "description": "brief description",
+      "negotiation_tips": "how to negotiate",
+      "example_phrase": "example phrase"
+    }}
+  ],
+  "summary": "overall summary"
+}}
+"""
+
+
+# Tier 1: exact prompt hash → response, persisted across runs.
+# Tier 2: semantic match — near-identical contexts (cosine > threshold)
+# reuse the stored response instead of re-invoking the LLM. Only the
+# variable context is embedded: the constant instruction/schema block
+# dominated whole-prompt vectors and made unrelated contracts look alike.
+LLM_CACHE = os.path.join(CACHE_DIR, "lease_llm_cache.db")
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+_prompt_index = None
+_prompt_contexts = []
+_prompt_responses = []
+
+
+def _call_llm(prompt, num_predict=500, context=None):
+    """Send a prompt to Ollama, with exact + semantic response caching.
+
+    context is the variable part of the prompt; it keys the semantic
+    tier. Without it only the exact tier applies.
+    """
+    global _prompt_index
+
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with shelve.open(LLM_CACHE) as store:
+        if key in store:
+            return store[key]
+
+    if context is not None:
+        context_vec = get_embedder().encode(
+            [context],
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).astype(np.float32)
+
+        if _prompt_index is not None and _prompt_index.ntotal > 0:
+            sims, ids = _prompt_index.search(context_vec, 1)
+            if sims[0][0] > SEMANTIC_CACHE_THRESHOLD:
+                # MiniLM truncates at 256 tokens, so the vector only sees
+                # the head of a long context — confirm the tails agree
+                # before serving the cached reply
+                if _prompt_contexts[ids[0][0]][-500:] == context[-500:]:
+                    return _prompt_responses[ids[0][0]]
+
+    result = _call_llm_uncached(prompt, num_predict)
+
+    with shelve.open(LLM_CACHE) as store:
+        store[key] = result
+    if context is not None:
+        if _prompt_index is None:
+            _prompt_index = faiss.IndexFlatIP(context_vec.shape[1])
+        _prompt_index.add(context_vec)
+        _prompt_contexts.append(context)
+        _prompt_responses.append(result)
+
+    return result
+
+
+# One pooled session per process: keep-alive instead of a fresh TCP (and
+# for remote backends, TLS) handshake on every LLM call.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+def _call_llm_uncached(prompt, num_predict=500):
+    """Send a prompt to Ollama, streaming tokens, and return the full text."""
+    try:
+        response = _SESSION.post(
+            OLLAMA_URL,
+            json={
+                "model": OLLAMA_MODEL,
+                "prompt": prompt,
+                "stream": True,
+                "options": {"num_predict": num_predict}
+            },
+            timeout=TIMEOUT,
+            stream=True
+        )
+    except requests.exceptions.ConnectionError:
+        raise RuntimeError("❌ Ollama is not running. Start it using: ollama serve")
+
+    if response.status_code != 200:
+        raise RuntimeError(f"Ollama error: {response.status_code} - {response.text}")
+
+    parts = []
+    for line in response.iter_lines():
+        if not line:
+            continue
+        payload = json.loads(line)
+        parts.append(payload.get("response", ""))
+        if payload.get("done"):
+            break
+
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_query_vec():
+    """The retrieval query is a fixed constant — encode it once per process."""
+    return get_embedder().encode(
+        [QUERY],
+        convert_to_numpy=True,
+        normalize_embeddings=True
+    ).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=64)
+def get_negotiation_advice(text):
+    """Run retrieval + Ollama negotiation advice over one document's text.
+
+    The lru_cache keys on the text itself, so re-analyzing an identical
+    contract returns the stored advice without touching the encoder or
+    the LLM again.
+    """
+    chunks = dedupe_chunks(chunk_text(text))
+    if not chunks:
+        return {"error": "No chunks created"}
+
+    embedder = get_embedder()
+    embeddings = _embed_cached(embedder, chunks)
+    index = build_index(embeddings)
+
+    _, indices = index.search(_get_query_vec(), min(TOP_K, len(chunks)))
+
+    context = select_context(chunks, indices)
+    if not context.strip():
+        return {"error": "No relevant lease clauses found"}
+
+    try:
+        result = _call_llm(build_prompt(context), context=context)
+    except RuntimeError as e:
+        return {"error": str(e)}
+
+    if len(result.strip()) < 10:
+        return {"error": "Weak output from Ollama", "raw": result}
+
+    try:
+        return json.loads(result)
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to parse JSON: {e}", "raw": result}
+
+
+# 7️⃣ CLI run over the whole output corpus
+def main():
+    if not os.path.exists(TEXT_DIR):
+        raise FileNotFoundError(f"TEXT_DIR not found: {TEXT_DIR}")
+
+    chunks = []
+    doc_count = 0
+    for doc in iter_docs():
+        doc_count += 1
+        chunks.extend(chunk_text(doc))
+
+    print(f"Loaded {doc_count} lease documents")
+
+    if doc_count == 0:
+        raise ValueError("No text files found or all files are empty")
+
+    chunks = dedupe_chunks(chunks)
+
+    print(f"Created {len(chunks)} text chunks")
+
+    if not chunks:
+        raise ValueError("Chunking failed — no chunks created")
+
+    embedder = get_embedder()
+    embeddings = _embed_cached(embedder, chunks)
+    index = _load_or_build_index(embeddings, chunks)
+
+    print("FAISS index built")
+
+    _, indices = index.search(_get_query_vec(), TOP_K)
+
+    context = select_context(chunks, indices)
+
+    if not context.strip():
+        raise ValueError("❌ No relevant lease clauses found")
+
+    print("\n--- CONTEXT SENT TO OLLAMA ---")
+    print(context[:1000])
+    print("--------------------------------")
+
+    print("\nGenerating negotiation advice...\n")
+
+    result = _call_llm(build_prompt(context), context=context)
+
+    if len(result.strip()) < 10:
+        print("\n⚠️ Weak output from Ollama")
+        print("Raw result:", repr(result))
+    else:
+        try:
+            parsed = json.loads(result)
+            print("Parsed JSON:")
+            print(json.dumps(parsed, indent=2))
+        except json.JSONDecodeError as e:
+            print(f"\n❌ Failed to parse JSON: {e}")
+            print("Raw result:")
+            print(result)
+
+    print("\n\n" + "=" * 60)
+    print("NEGOTIATION ADVICE (GEMMA)")
+    print("=" * 60)
+    # The JSON is already printed above
+
+
+if __name__ == "__main__":
+    main()
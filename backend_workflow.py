@@ -1,7 +1,10 @@
 import os
 import json
+import fitz  # PyMuPDF
 import pytesseract
 from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import re
 from vehicle_enrichment import extract_vehicle_info
 
@@ -9,49 +12,68 @@ from vehicle_enrichment import extract_vehicle_info
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 POPPLER_PATH = r"C:\Users\revan\Downloads\InfosysSpringboard\poppler-25.12.0\Library\bin"
 
-def preprocess_pdf(pdf_path):
-    """Extract text from PDF file path"""
+def preprocess_pdf(pdf_path, dpi=200):
+    """Extract text from PDF file path, OCRing pages in parallel.
+
+    Born-digital PDFs (e.g. leases exported from Word) carry a text layer
+    that is orders of magnitude cheaper to read than rasterize+OCR, so
+    that is tried first; scan-only PDFs fall through to Tesseract.
+
+    Tesseract is single-threaded per page, so pages are fanned out to a
+    process pool. DPI defaults to 200: accuracy on typed leases plateaus
+    around there and rasterization cost scales with DPI squared.
+    """
+    doc = fitz.open(pdf_path)
+    page_texts = [page.get_text("text") for page in doc]
+    has_text_layer = sum(len(t.strip()) for t in page_texts) > 200 * doc.page_count
+    doc.close()
+
+    if has_text_layer:
+        full_text = ""
+        for i, text in enumerate(page_texts, start=1):
+            full_text += f"\n--- Page {i} ---\n"
+            full_text += text
+        return full_text
+
     pages = convert_from_path(
         pdf_path,
-        dpi=300,
-        poppler_path=POPPLER_PATH
+        dpi=dpi,
+        poppler_path=POPPLER_PATH,
+        thread_count=os.cpu_count()
     )
 
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(pages))) as executor:
+        page_texts = list(executor.map(
+            partial(pytesseract.image_to_string, lang="eng"),
+            pages
+        ))
+
     full_text = ""
-    for i, page in enumerate(pages, start=1):
+    for i, text in enumerate(page_texts, start=1):
         full_text += f"\n--- Page {i} ---\n"
-        full_text += pytesseract.image_to_string(page, lang="eng")
+        full_text += text
 
     return full_text
 
+# Single alternation compiled once: one pass over the text instead of
+# one full re.search sweep per field.
+_DATAPOINT_RE = re.compile(
+    r"(?:Fees:\s*(?P<fee_details>.*?)"
+    r"|Deposit:\s*(?P<deposit_details>.*?)"
+    r"|Mileage Limit(?P<mileage_limit_details>.*?)"
+    r"|Excess Mileage:\s*(?P<excess_mileage_details>.*?)"
+    r"|Fuel:\s*(?P<fuel_details>.*?))(?:\n|$)",
+    re.IGNORECASE
+)
+
 def extract_datapoints(text):
     """Extract key datapoints from lease text"""
     datapoints = {}
 
-    # Extract fees
-    fee_match = re.search(r'Fees:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if fee_match:
-        datapoints['fee_details'] = fee_match.group(1).strip()
-
-    # Extract deposit
-    deposit_match = re.search(r'Deposit:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if deposit_match:
-        datapoints['deposit_details'] = deposit_match.group(1).strip()
-
-    # Extract mileage limit
-    mileage_match = re.search(r'Mileage Limit(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if mileage_match:
-        datapoints['mileage_limit_details'] = mileage_match.group(1).strip()
-
-    # Extract excess mileage
-    excess_match = re.search(r'Excess Mileage:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if excess_match:
-        datapoints['excess_mileage_details'] = excess_match.group(1).strip()
-
-    # Extract fuel
-    fuel_match = re.search(r'Fuel:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if fuel_match:
-        datapoints['fuel_details'] = fuel_match.group(1).strip()
+    for m in _DATAPOINT_RE.finditer(text):
+        name = m.lastgroup
+        if name and name not in datapoints:
+            datapoints[name] = m.group(name).strip()
 
     return datapoints
 
@@ -1,13 +1,29 @@
 import os
-import faiss
 import json
+import heapq
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+import torch
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer
+from Tokenization import OnnxEmbedder, ONNX_MODEL_DIR
+
+# CPU encoding leaves most cores idle under torch's default thread count
+torch.set_num_threads(os.cpu_count())
 import pytesseract
+from PIL import Image
 from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor
 import tempfile
 
+try:
+    # In-process Tesseract API: no subprocess fork or model re-load per page
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
 # ---------------- CONFIG ----------------
 TEXT_DIR = r"C:\Users\revan\Downloads\InfosysSpringboard\output"
 EMBED_MODEL = "all-MiniLM-L6-v2"
@@ -16,6 +32,41 @@ TOP_K = 6
 MAX_CONTEXT_WORDS = 400
 OLLAMA_URL = "http://localhost:11434/api/generate"
 TIMEOUT = 600
+CACHE_DIR = "cache"
+QUERY_TEXT = "contract fairness red flags penalties unfair terms termination fees deposits mileage insurance"
+
+# Pooled keep-alive session: batch analysis of many contracts reuses one
+# TCP connection to Ollama instead of reconnecting per call
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+# Shared instruction + schema block for the fairness prompt. Kept constant
+# and placed at the very start of every prompt so the prefill for it can
+# be reused across requests; only the contract clauses at the tail vary.
+SYSTEM_PREFIX = """
+You are a legal expert analyzing lease contracts for fairness and red flags.
+
+Analyze the contract clauses below for:
+1. Fairness Score: Rate the overall fairness of the contract on a scale of 1-10 (1 = very unfair, 10 = very fair). Consider factors like balance of rights, clarity, reasonableness of terms.
+2. Red Flags: List any potentially unfair, risky, or problematic clauses (e.g., high penalties, one-sided terms, hidden fees).
+
+Use ONLY the clauses provided. Be objective and specific.
+
+Respond with a JSON object in the following format:
+{
+  "fairness_score": 7,
+  "red_flags": [
+    {
+      "clause": "brief description of clause",
+      "issue": "why it's a red flag",
+      "severity": "low/medium/high"
+    }
+  ],
+  "summary": "brief overall assessment"
+}
+"""
 
 # Paths for OCR
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
@@ -23,18 +74,62 @@ POPPLER_PATH = r"C:\Users\revan\Downloads\InfosysSpringboard\poppler-25.12.0\Lib
 
 # ---------------- FUNCTIONS ----------------
 
-def preprocess_pdf_to_text(pdf_path):
-    """Extract text from PDF using OCR (from datapreprocessingandextraction.py)"""
-    pages = convert_from_path(
-        pdf_path,
-        dpi=300,
-        poppler_path=POPPLER_PATH
-    )
+_ocr_api = None
+
+
+def _init_ocr_worker():
+    # One Tesseract thread per worker — the pool provides the parallelism,
+    # so let OpenMP inside Tesseract not oversubscribe the cores.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    global _ocr_api
+    if PyTessBaseAPI is not None:
+        # one long-lived Tesseract instance per worker, reused across pages
+        _ocr_api = PyTessBaseAPI(lang="eng")
+
+
+def _ocr_page(page):
+    # 1-bit binarization: Tesseract re-binarizes internally anyway, and a
+    # clean bilevel input is 24x fewer bytes per pixel than RGB
+    page = page.convert("L").point(lambda p: 0 if p < 180 else 255, mode="1")
+    if _ocr_api is not None:
+        _ocr_api.SetImage(page)
+        return _ocr_api.GetUTF8Text()
+    return pytesseract.image_to_string(page, lang="eng")
+
+
+def _ocr_page_path(path):
+    with Image.open(path) as page:
+        return _ocr_page(page)
+
+
+def preprocess_pdf_to_text(pdf_path, dpi=200):
+    """Extract text from PDF using OCR, one pool worker per page.
+
+    DPI defaults to 200 — accuracy on typed leases plateaus around there
+    and rasterization cost scales with DPI squared; pass 300 for noisy
+    scans. Page rasters stay on disk (paths_only) so peak memory is
+    O(workers), not O(pages).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_paths = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            poppler_path=POPPLER_PATH,
+            output_folder=tmp_dir,
+            fmt="png",
+            paths_only=True
+        )
+
+        with ProcessPoolExecutor(
+            max_workers=min(os.cpu_count(), len(page_paths)),
+            initializer=_init_ocr_worker
+        ) as executor:
+            page_texts = list(executor.map(_ocr_page_path, page_paths))
 
     full_text = ""
-    for i, page in enumerate(pages, start=1):
+    for i, text in enumerate(page_texts, start=1):
         full_text += f"\n--- Page {i} ---\n"
-        full_text += pytesseract.image_to_string(page, lang="eng")
+        full_text += text
 
     return full_text
 
@@ -44,95 +139,178 @@ def load_text_from_file(file_path):
         return f.read().strip()
 
 def chunk_text(text, chunk_size=120):
-    """Chunk text (from Tokenization.py)"""
-    words = text.split()
-    return [
-        " ".join(words[i:i + chunk_size])
-        for i in range(0, len(words), chunk_size)
-        if len(words[i:i + chunk_size]) > 20
-    ]
+    """Chunk text; returns (chunks, word_counts).
 
-def analyze_contract_fairness(text):
-    """Analyze contract for fairness score and red flags using FAISS and Ollama"""
-    chunks = chunk_text(text)
+    Word counts come straight from the window arithmetic so downstream
+    context budgeting never has to re-split the chunks.
+    """
+    words = text.split()
+    n = len(words)
+    starts = [i for i in range(0, n, chunk_size) if n - i > 20]
+    chunks = [" ".join(words[i:i + chunk_size]) for i in starts]
+    word_counts = np.array([min(chunk_size, n - i) for i in starts], dtype=np.int32)
+    return chunks, word_counts
+
+@lru_cache(maxsize=1)
+def _get_embedder():
+    # Model load costs seconds — keep one instance per process. The INT8
+    # ONNX export (see OnnxEmbedder) is 2-4x faster on CPU when present.
+    if os.path.isdir(ONNX_MODEL_DIR):
+        return OnnxEmbedder(ONNX_MODEL_DIR)
+    return SentenceTransformer(EMBED_MODEL)
+
+
+def _load_or_compute_embeddings(text):
+    """Return (chunks, embeddings) for text, cached on disk by content hash.
+
+    Re-analyzing the same contract loads the stored .npy instead of
+    re-running the encoder.
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    npy_path = os.path.join(CACHE_DIR, f"{key}.npy")
+    json_path = os.path.join(CACHE_DIR, f"{key}.json")
+
+    if os.path.exists(npy_path) and os.path.exists(json_path):
+        with open(json_path, "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        # fp16 at rest, fp32 for the BLAS matvec
+        return chunks, np.load(npy_path).astype(np.float32)
+
+    chunks, _ = chunk_text(text)
     if not chunks:
-        return {"error": "No chunks created from text"}
+        return [], None
 
-    # Embeddings (from Tokenization.py)
-    embedder = SentenceTransformer(EMBED_MODEL)
-    embeddings = embedder.encode(
+    embeddings = _get_embedder().encode(
         chunks,
+        batch_size=64,
+        show_progress_bar=False,
         convert_to_numpy=True,
         normalize_embeddings=True
     ).astype(np.float32)
 
-    index = faiss.IndexFlatL2(embeddings.shape[1])
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # half the bytes on disk; ample precision for normalized cosine
+    np.save(npy_path, embeddings.astype(np.float16))
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(chunks, f)
+
+    return chunks, embeddings
+
+
+def _top_k_indices(embeddings, query_vec, k):
+    """Rank chunks against one query vector.
+
+    Small corpora get a single BLAS matvec; above ~2000 vectors an
+    IVF-PQ index restricts the scan to nprobe cells and cuts memory 4x+.
+    """
+    n = embeddings.shape[0]
+    k = min(k, n)
+
+    if n < 2000:
+        sims = embeddings @ query_vec
+        idx = np.argpartition(-sims, k - 1)[:k]
+        return idx[np.argsort(-sims[idx])]
+
+    import faiss
+    index = faiss.index_factory(
+        embeddings.shape[1], "IVF64,PQ32", faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(embeddings)
     index.add(embeddings)
+    index.nprobe = 8
+    _, ids = index.search(query_vec.reshape(1, -1), k)
+    return ids[0]
+
 
-    # Query for fairness-related content
-    query = "contract fairness red flags penalties unfair terms termination fees deposits mileage insurance"
-    query_embedding = embedder.encode(
-        [query],
+@lru_cache(maxsize=1)
+def _get_query_vec():
+    # The fairness query never changes; one encoder pass per process
+    return _get_embedder().encode(
+        [QUERY_TEXT],
         convert_to_numpy=True,
         normalize_embeddings=True
-    ).astype(np.float32)
-
-    _, indices = index.search(query_embedding, TOP_K)
+    )
 
-    # Collect context chunks (top relevant, no keyword filter)
-    context_chunks = []
-    word_count = 0
 
-    for i in indices[0]:
-        chunk = chunks[i]
-        words = chunk.split()
-        if word_count + len(words) > MAX_CONTEXT_WORDS:
+def _streaming_top_k(chunks, query_vec, k, batch_size=32, stop_score=0.6):
+    """Encode chunks in mini-batches, keeping a running top-k heap.
+
+    Remaining batches are skipped once the k-th best inner product clears
+    stop_score — the clauses relevant to the fairness query cluster in a
+    few sections of a lease, so later batches rarely displace the heap.
+    Used for long documents where encoding everything up front wastes
+    most of the encoder FLOPs on chunks that never reach the context.
+    """
+    embedder = _get_embedder()
+    heap = []  # (score, chunk index), min-heap on score
+
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start:start + batch_size]
+        emb = embedder.encode(
+            batch,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        sims = emb @ query_vec
+        for j, score in enumerate(sims):
+            item = (float(score), start + j)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+        if len(heap) == k and heap[0][0] >= stop_score:
             break
-        context_chunks.append(chunk)
-        word_count += len(words)
 
-    context = "\n\n".join(context_chunks)
-    if not context.strip():
-        return {"error": "No relevant contract clauses found for analysis"}
+    return [i for _, i in sorted(heap, reverse=True)]
 
-    # Prompt for fairness analysis
-    prompt = f"""
-You are a legal expert analyzing lease contracts for fairness and red flags.
 
-Analyze the contract clauses below for:
-1. Fairness Score: Rate the overall fairness of the contract on a scale of 1-10 (1 = very unfair, 10 = very fair). Consider factors like balance of rights, clarity, reasonableness of terms.
-2. Red Flags: List any potentially unfair, risky, or problematic clauses (e.g., high penalties, one-sided terms, hidden fees).
+def analyze_contract_fairness(text):
+    """Analyze contract for fairness score and red flags using FAISS and Ollama"""
+    chunks, word_counts = chunk_text(text)
+    if not chunks:
+        return {"error": "No chunks created from text"}
 
-Use ONLY the clauses provided. Be objective and specific.
+    # Query for fairness-related content (constant — encoded once)
+    query_embedding = _get_query_vec()
 
-Contract clauses:
-{context}
+    if len(chunks) > 512:
+        # Very long leases: stream-encode with early abort instead of
+        # embedding (and caching) every chunk up front
+        top_idx = _streaming_top_k(chunks, query_embedding[0], TOP_K)
+    else:
+        chunks, embeddings = _load_or_compute_embeddings(text)
+        top_idx = _top_k_indices(embeddings, query_embedding[0], TOP_K)
 
-Respond with a JSON object in the following format:
-{{
-  "fairness_score": 7,
-  "red_flags": [
-    {{
-      "clause": "brief description of clause",
-      "issue": "why it's a red flag",
-      "severity": "low/medium/high"
-    }}
-  ],
-  "summary": "brief overall assessment"
-}}
-"""
+    # Collect context chunks (top relevant, no keyword filter). Word
+    # counts are prefix-summed, so the budget cut is branchless and no
+    # chunk gets re-split.
+    top_idx = np.asarray(top_idx)
+    picked = top_idx[np.cumsum(word_counts[top_idx]) <= MAX_CONTEXT_WORDS]
+
+    context = "\n\n".join(chunks[i] for i in picked)
+    if not context.strip():
+        return {"error": "No relevant contract clauses found for analysis"}
+
+    # Static prefix first, variable clauses last: the instruction/schema
+    # block hits Ollama's prefix KV-cache on every contract after the first
+    prompt = SYSTEM_PREFIX + f"\n\nContract clauses:\n{context}\n"
 
-    # Ollama call (from Tokenization.py)
+    # Ollama call (from Tokenization.py) — streamed, so parsing overlaps
+    # generation and we can stop as soon as the JSON object closes
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_URL,
             json={
                 "model": OLLAMA_MODEL,
                 "prompt": prompt,
-                "stream": False,
+                "stream": True,
+                "format": "json",  # constrain decoding to valid JSON
                 "options": {"num_predict": 600}
             },
-            timeout=TIMEOUT
+            timeout=TIMEOUT,
+            stream=True
         )
     except requests.exceptions.ConnectionError:
         return {"error": "Ollama is not running. Start it using: ollama serve"}
@@ -140,17 +318,54 @@ Respond with a JSON object in the following format:
     if response.status_code != 200:
         return {"error": f"Ollama error: {response.status_code} - {response.text}"}
 
-    data = response.json()
-    result = data.get("response", "")
+    parts = []
+    depth = 0
+    started = False
+    in_string = False
+    escaped = False
+    for line in response.iter_lines():
+        if not line:
+            continue
+        payload = json.loads(line)
+        token = payload.get("response", "")
+        parts.append(token)
+        # cheap brace tracker: once the top-level object closes there is
+        # nothing left worth waiting for. Braces inside string literals
+        # don't count, so a summary mentioning "}" can't truncate us.
+        for ch in token:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+                started = True
+            elif ch == "}":
+                depth -= 1
+        if (started and depth <= 0) or payload.get("done"):
+            break
+    response.close()
+
+    result = "".join(parts)
 
     if len(result.strip()) < 10:
         return {"error": "Weak output from Ollama", "raw": result}
 
     try:
-        parsed = json.loads(result)
-        return parsed
+        return json.loads(result)
     except json.JSONDecodeError as e:
-        return {"error": f"Failed to parse JSON: {e}", "raw": result}
+        # Recover from stray prose/tokens without a second multi-second
+        # LLM call; json_repair handles most malformed outputs
+        try:
+            import json_repair
+            return json_repair.loads(result)
+        except Exception:
+            return {"error": f"Failed to parse JSON: {e}", "raw": result}
 
 # ---------------- MAIN ----------------
 
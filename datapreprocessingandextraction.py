@@ -1,6 +1,18 @@
 import os
+import argparse
+import hashlib
+import tempfile
 import pytesseract
+from PIL import Image
 from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+try:
+    # In-process Tesseract API: no subprocess fork or model re-load per page
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
 
 # ------------------ PATHS ------------------
 
@@ -18,36 +30,127 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 # ------------------ OCR FUNCTION ------------------
 
-def extract_text_from_pdf(pdf_path):
-    pages = convert_from_path(
-        pdf_path,
-        dpi=300,
-        poppler_path=POPPLER_PATH
-    )
+_ocr_api = None
+
+
+def _init_ocr_worker():
+    # One Tesseract thread per worker — the pool provides the parallelism
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    global _ocr_api
+    if PyTessBaseAPI is not None:
+        # one long-lived Tesseract instance per worker, reused across pages
+        _ocr_api = PyTessBaseAPI(lang="eng")
+
+
+def _ocr_page(page):
+    # 1-bit binarization: Tesseract re-binarizes internally anyway, and a
+    # clean bilevel input is 24x fewer bytes per pixel than RGB
+    page = page.convert("L").point(lambda p: 0 if p < 180 else 255, mode="1")
+    if _ocr_api is not None:
+        _ocr_api.SetImage(page)
+        return _ocr_api.GetUTF8Text()
+    return pytesseract.image_to_string(page, lang="eng")
+
+
+def _ocr_page_path(path):
+    with Image.open(path) as page:
+        return _ocr_page(page)
+
+
+def extract_text_from_pdf(pdf_path, dpi=200, max_workers=None):
+    # paths_only keeps page rasters on disk: each worker holds one page
+    # in memory at a time, so peak RSS is O(workers) not O(pages)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_paths = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            poppler_path=POPPLER_PATH,
+            output_folder=tmp_dir,
+            fmt="png",
+            paths_only=True
+        )
+
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(page_paths)),
+            initializer=_init_ocr_worker
+        ) as executor:
+            page_texts = list(executor.map(_ocr_page_path, page_paths))
 
     full_text = ""
-    for i, page in enumerate(pages, start=1):
+    for i, text in enumerate(page_texts, start=1):
         full_text += f"\n--- Page {i} ---\n"
-        full_text += pytesseract.image_to_string(page, lang="eng")
+        full_text += text
 
     return full_text
 
 # ------------------ PROCESS PDFs ------------------
 
-for file in os.listdir(PDF_FOLDER):
-    if file.lower().endswith(".pdf"):
-        pdf_path = os.path.join(PDF_FOLDER, file)
-        output_txt = os.path.join(
-            OUTPUT_FOLDER,
-            file.replace(".pdf", ".txt")
-        )
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def process_one(file, dpi=200):
+    """OCR a single PDF to its .txt, skipping unchanged files."""
+    pdf_path = os.path.join(PDF_FOLDER, file)
+    output_txt = os.path.join(
+        OUTPUT_FOLDER,
+        file.replace(".pdf", ".txt")
+    )
+
+    # Skip OCR (the dominant cost) when the PDF hasn't changed
+    # since the stored .txt was produced
+    pdf_hash = _file_sha256(pdf_path)
+    hash_path = output_txt + ".sha256"
+    if os.path.exists(output_txt) and os.path.exists(hash_path):
+        with open(hash_path, "r", encoding="utf-8") as f:
+            if f.read().strip() == pdf_hash:
+                print(f"⏭️ Unchanged, skipping: {file}")
+                return
+
+    print(f"🔍 Processing: {file}")
+    # Each document worker keeps its page pool small so documents x pages
+    # doesn't oversubscribe the cores
+    text = extract_text_from_pdf(pdf_path, dpi=dpi, max_workers=2)
+
+    # Atomic write so an interrupted run never leaves a truncated
+    # .txt that a matching hash would mark as valid
+    tmp_path = output_txt + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, output_txt)
+    with open(hash_path, "w", encoding="utf-8") as f:
+        f.write(pdf_hash)
+
+    print(f"✅ Saved: {output_txt}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR all lease PDFs to text")
+    parser.add_argument(
+        "--dpi", type=int, default=200,
+        help="rasterization DPI (use 300 for noisy scans)"
+    )
+    args = parser.parse_args()
+
+    pdf_files = [f for f in os.listdir(PDF_FOLDER) if f.lower().endswith(".pdf")]
 
-        print(f"🔍 Processing: {file}")
-        text = extract_text_from_pdf(pdf_path)
+    # Independent documents are embarrassingly parallel; half the cores
+    # here, the rest go to each document's page workers
+    with ProcessPoolExecutor(
+        max_workers=max(1, os.cpu_count() // 2),
+        initializer=_init_ocr_worker
+    ) as executor:
+        list(executor.map(partial(process_one, dpi=args.dpi), pdf_files))
 
-        with open(output_txt, "w", encoding="utf-8") as f:
-            f.write(text)
+    print("\n🎉 OCR extraction completed successfully!")
 
-        print(f"✅ Saved: {output_txt}")
 
-print("\n🎉 OCR extraction completed successfully!")
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,231 @@
 import streamlit as st
 import os
 import pytesseract
-from pdf2image import convert_from_path
+from concurrent.futures import ThreadPoolExecutor
+import fitz
+from PIL import Image
 import tempfile
+import shutil
 import re
-import faiss
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
+from Tokenization import OnnxEmbedder, ONNX_MODEL_DIR
 
 # ---------------- CONFIG ----------------
 EMBED_MODEL = "all-MiniLM-L6-v2"
 OLLAMA_MODEL = "gemma:2b"
 TOP_K = 6
 MAX_CONTEXT_WORDS = 400
+QUERY = "lease payment fees penalties early termination mileage insurance"
 OLLAMA_URL = "http://localhost:11434/api/generate"
 TIMEOUT = 600
+OCR_DPI = 200
+# OEM 1 = LSTM engine only; pairs with the tessdata_fast eng model for
+# a 2-4x OCR speedup on typed leases. PSM 6 suits uniform contract text.
+TESS_CONFIG = "--oem 1 --psm 6"
+
+# Static prompt halves built once at import; only the lease context is
+# spliced in per call
+PROMPT_PREFIX = """
+You are a professional car lease negotiation expert.
+
+Using ONLY the lease clauses below:
+1. Identify negotiable fees, deposits, mileage limits, penalties
+2. Explain how customers can negotiate each item
+3. Provide example negotiation phrases customers can say
+
+Lease clauses:
+"""
+
+PROMPT_SUFFIX = """
+
+Respond with a JSON object in the following format:
+{
+  "negotiable_items": [
+    {
+      "item": "fee name",
+      "description": "brief description",
+      "negotiation_tips": "how to negotiate",
+      "example_phrase": "example phrase"
+    }
+  ],
+  "summary": "overall summary"
+}
+"""
+
+# Keep-alive pool so repeated advice requests reuse the Ollama socket
+# instead of reconnecting per call
+_HTTP = requests.Session()
+_HTTP.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+_HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
 # Paths
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-POPPLER_PATH = r"C:\Users\revan\Downloads\InfosysSpringboard\poppler-25.12.0\Library\bin"
 
 # ---------------- FUNCTIONS ----------------
 
+def _ocr_page(args):
+    pdf_path, page_num = args
+    # Each worker opens its own handle (cheap, MuPDF parses lazily) and
+    # renders straight to grayscale — a third of the pixel bytes of RGB,
+    # and Tesseract works on grayscale anyway. MuPDF releases the GIL
+    # while rendering, so threads parallelize rasterization too.
+    with fitz.open(pdf_path) as doc:
+        pix = doc[page_num].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+    page = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    # 1-bit binarization: Tesseract re-thresholds internally anyway, and
+    # a bilevel input is 8x fewer bytes through the pytesseract temp file
+    page = page.point(lambda p: 0 if p < 180 else 255, mode="1")
+    return pytesseract.image_to_string(page, lang="eng", config=TESS_CONFIG)
+
 def preprocess_pdf(uploaded_file):
     """Extract text from uploaded PDF"""
     with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-        tmp_file.write(uploaded_file.read())
+        # Copy in 1 MB chunks so a large upload never materializes as
+        # one bytes object in memory
+        shutil.copyfileobj(uploaded_file, tmp_file, length=1024 * 1024)
         tmp_path = tmp_file.name
 
     try:
-        pages = convert_from_path(
-            tmp_path,
-            dpi=300,
-            poppler_path=POPPLER_PATH
-        )
+        # Born-digital PDFs already carry a text layer that is orders of
+        # magnitude faster to read than OCR — use it when it looks real
+        doc = fitz.open(tmp_path)
+        page_texts = [page.get_text("text") for page in doc]
+        page_count = doc.page_count
+        doc.close()
+        if sum(len(t.strip()) for t in page_texts) > 200 * page_count:
+            full_text = ""
+            for i, text in enumerate(page_texts, start=1):
+                full_text += f"\n--- Page {i} ---\n"
+                full_text += text
+            return full_text
+
+        # Render pages in-process with MuPDF — no pdftoppm subprocess,
+        # no temp rasters. Each worker renders one page at a time, so
+        # peak memory stays O(workers) rather than O(pages).
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count(), page_count)) as executor:
+            page_texts = list(executor.map(
+                _ocr_page, [(tmp_path, i) for i in range(page_count)]
+            ))
 
         full_text = ""
-        for i, page in enumerate(pages, start=1):
+        for i, text in enumerate(page_texts, start=1):
             full_text += f"\n--- Page {i} ---\n"
-            full_text += pytesseract.image_to_string(page, lang="eng")
+            full_text += text
 
         return full_text
     finally:
         os.unlink(tmp_path)
 
+# One alternation with named groups: the text is scanned once instead of
+# five times, and the pattern is compiled once at import
+_DATAPOINT_RE = re.compile(
+    r"(?:Fees:\s*(?P<fee_details>.*?)"
+    r"|Deposit:\s*(?P<deposit_details>.*?)"
+    r"|Mileage Limit(?P<mileage_limit_details>.*?)"
+    r"|Excess Mileage:\s*(?P<excess_mileage_details>.*?)"
+    r"|Fuel:\s*(?P<fuel_details>.*?))(?:\n|$)",
+    re.IGNORECASE
+)
+
 def extract_datapoints(text):
     """Extract key datapoints from lease text"""
     datapoints = {}
 
-    # Extract fees
-    fee_match = re.search(r'Fees:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if fee_match:
-        datapoints['fee_details'] = fee_match.group(1).strip()
-
-    # Extract deposit
-    deposit_match = re.search(r'Deposit:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if deposit_match:
-        datapoints['deposit_details'] = deposit_match.group(1).strip()
-
-    # Extract mileage limit
-    mileage_match = re.search(r'Mileage Limit(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if mileage_match:
-        datapoints['mileage_limit_details'] = mileage_match.group(1).strip()
-
-    # Extract excess mileage
-    excess_match = re.search(r'Excess Mileage:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if excess_match:
-        datapoints['excess_mileage_details'] = excess_match.group(1).strip()
-
-    # Extract fuel
-    fuel_match = re.search(r'Fuel:\s*(.*?)(?:\n|$)', text, re.IGNORECASE)
-    if fuel_match:
-        datapoints['fuel_details'] = fuel_match.group(1).strip()
+    for m in _DATAPOINT_RE.finditer(text):
+        name = m.lastgroup
+        if name and name not in datapoints:
+            datapoints[name] = m.group(name).strip()
 
     return datapoints
 
-def get_negotiation_advice(text):
-    """Get negotiation advice using FAISS and Ollama"""
-    # Chunk text
+@st.cache_resource
+def get_embedder():
+    """Load the embedding model once per server process, on the best device"""
+    # The INT8 ONNX export (see OnnxEmbedder) is 2-4x faster on CPU
+    # when the exported model dir is present
+    if os.path.isdir(ONNX_MODEL_DIR):
+        return OnnxEmbedder(ONNX_MODEL_DIR)
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        device = "cpu"
+        torch.set_num_threads(os.cpu_count())
+    return SentenceTransformer(EMBED_MODEL, device=device)
+
+@st.cache_data(show_spinner=False)
+def _embed_chunks(text):
+    """Chunk and embed text, cached by content hash.
+
+    Streamlit reruns the script top to bottom on every interaction, so
+    repeat button presses on the same document skip the encoder entirely.
+    """
     def chunk_text(text, chunk_size=120):
+        # One split, one slice per chunk — the old filter sliced each
+        # window a second time just to measure it
         words = text.split()
+        n = len(words)
         return [
             " ".join(words[i:i + chunk_size])
-            for i in range(0, len(words), chunk_size)
-            if len(words[i:i + chunk_size]) > 20
+            for i in range(0, n, chunk_size)
+            if n - i > 20
         ]
 
     chunks = chunk_text(text)
     if not chunks:
-        return {"error": "No chunks created"}
+        return [], None
+
+    # Encode in length order so each batch pads to similar lengths,
+    # then scatter back to the original chunk order
+    embedder = get_embedder()
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i].split()))
+    sorted_embs = embedder.encode(
+        [chunks[i] for i in order],
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        batch_size=32,
+        show_progress_bar=False
+    ).astype(np.float32)
+    embeddings = np.empty_like(sorted_embs)
+    embeddings[order] = sorted_embs
+    # fp16 halves the cached bytes; retrieval widens back to fp32 at
+    # search time with no measurable recall loss on unit vectors
+    return chunks, embeddings.astype(np.float16)
+
+@st.cache_data(show_spinner=False)
+def _get_query_embedding():
+    """The retrieval query never changes — encode it once per process"""
+    embedder = get_embedder()
+    return embedder.encode(
+        [QUERY], convert_to_numpy=True, normalize_embeddings=True
+    ).astype(np.float32)
 
-    # Embeddings
-    embedder = SentenceTransformer(EMBED_MODEL)
-    embeddings = embedder.encode(chunks, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+def get_negotiation_advice(text):
+    """Get negotiation advice using FAISS and Ollama"""
+    chunks, embeddings = _embed_chunks(text)
+    if not chunks:
+        return {"error": "No chunks created"}
 
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
+    query_embedding = _get_query_embedding()
 
-    # Query
-    query = "lease payment fees penalties early termination mileage insurance"
-    query_embedding = embedder.encode([query], convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
-    _, indices = index.search(query_embedding, TOP_K)
+    # A document yields a few dozen normalized vectors — one BLAS matvec
+    # is cosine similarity directly, no FAISS index build needed
+    scores = embeddings.astype(np.float32) @ query_embedding[0]
+    k = min(TOP_K, len(chunks))
+    top = np.argpartition(-scores, k - 1)[:k]
+    indices = top[np.argsort(-scores[top])]
 
     # Filter context
     context_chunks = []
     word_count = 0
 
-    for i in indices[0]:
+    for i in indices:
         chunk = chunks[i]
         words = chunk.split()
         if word_count + len(words) > MAX_CONTEXT_WORDS:
@@ -121,42 +238,22 @@ def get_negotiation_advice(text):
         return {"error": "No relevant lease clauses found"}
 
     # Prompt
-    prompt = f"""
-You are a professional car lease negotiation expert.
+    prompt = PROMPT_PREFIX + context + PROMPT_SUFFIX
 
-Using ONLY the lease clauses below:
-1. Identify negotiable fees, deposits, mileage limits, penalties
-2. Explain how customers can negotiate each item
-3. Provide example negotiation phrases customers can say
-
-Lease clauses:
-{context}
-
-Respond with a JSON object in the following format:
-{{
-  "negotiable_items": [
-    {{
-      "item": "fee name",
-      "description": "brief description",
-      "negotiation_tips": "how to negotiate",
-      "example_phrase": "example phrase"
-    }}
-  ],
-  "summary": "overall summary"
-}}
-"""
-
-    # Ollama call
+    # Ollama call — stream tokens so we can stop as soon as the JSON
+    # object closes instead of waiting out the full num_predict budget
     try:
-        response = requests.post(
+        response = _HTTP.post(
             OLLAMA_URL,
             json={
                 "model": OLLAMA_MODEL,
                 "prompt": prompt,
-                "stream": False,
+                "stream": True,
+                "format": "json",
                 "options": {"num_predict": 500}
             },
-            timeout=TIMEOUT
+            timeout=TIMEOUT,
+            stream=True
         )
     except requests.exceptions.ConnectionError:
         return {"error": "Ollama is not running"}
@@ -164,16 +261,56 @@ Respond with a JSON object in the following format:
     if response.status_code != 200:
         return {"error": f"Ollama error: {response.text}"}
 
-    data = response.json()
-    result = data.get("response", "")
+    parts = []
+    depth = 0
+    started = False
+    in_string = False
+    escaped = False
+    for line in response.iter_lines():
+        if not line:
+            continue
+        payload = json.loads(line)
+        token = payload.get("response", "")
+        parts.append(token)
+        # Braces inside string literals don't count, so advice text that
+        # mentions "}" can't truncate the reply mid-string
+        for ch in token:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+                started = True
+            elif ch == "}":
+                depth -= 1
+        if (started and depth <= 0) or payload.get("done"):
+            break
+    response.close()
+
+    result = "".join(parts)
 
     if len(result.strip()) < 10:
         return {"error": "Weak output from Ollama", "raw": result}
 
     try:
-        parsed = json.loads(result)
-        return parsed
+        return json.loads(result)
     except json.JSONDecodeError as e:
+        # O(n) recovery: try raw_decode from each '{' rather than a
+        # backtracking regex over the whole malformed output
+        decoder = json.JSONDecoder()
+        pos = result.find("{")
+        while pos != -1:
+            try:
+                parsed, _ = decoder.raw_decode(result, pos)
+                return parsed
+            except json.JSONDecodeError:
+                pos = result.find("{", pos + 1)
         return {"error": f"Failed to parse JSON: {e}", "raw": result}
 
 # ---------------- STREAMLIT UI ----------------
@@ -0,0 +1,424 @@
+import os
+import re
+import json
+import requests
+from requests.adapters import HTTPAdapter, Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+# ---------------- CONFIG ----------------
+NHTSA_DECODE_URL = "https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVin/{vin}?format=json"
+NHTSA_BATCH_DECODE_URL = "https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVINValuesBatch/"
+NHTSA_RECALLS_URL = "https://api.nhtsa.gov/recalls/recallsByVehicle"
+OLLAMA_MODEL = "gemma:2b"
+OLLAMA_URL = "http://localhost:11434/api/generate"
+MISTRAL_URL = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_MODEL = "mistral-small-latest"
+# Read once at import — the key doesn't change mid-process, so the hot
+# path is a single predictable None check instead of an env lookup
+MISTRAL_API_KEY = os.environ.get("MISTRAL_API_KEY")
+# Fail fast on unreachable hosts (connect) while still allowing slow
+# generation (read) — a dead endpoint costs 5s, not 60
+TIMEOUT = (5, 60)
+# ---------------------------------------
+
+# Keep-alive connection pool: NHTSA and the LLM endpoints get hit several
+# times per document, and a fresh TCP+TLS handshake per call costs
+# ~100-300ms each
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10, pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2,
+                      status_forcelist=[502, 503, 504])
+))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+# Patterns compiled once at import; each per-call re.search with a string
+# literal pays the re-cache hash + lookup on every invocation
+# Bytes pattern, both cases: scanning the encoded text directly avoids
+# upper()-copying the whole document just to catch lowercase VINs
+VIN_RE = re.compile(rb"\b[A-HJ-NPR-Za-hj-npr-z0-9]{17}\b")
+# One alternation with named groups so the text is walked once for all
+# vehicle datapoints instead of once per field. Separators are mandatory
+# and values must run to end of line: blank fill-in forms stack labels
+# ("Make: Model:") and first-match-wins would otherwise capture the next
+# label as the value and feed it to the NHTSA APIs. Only horizontal
+# whitespace after the colon, so an empty field can't grab the next line.
+_CAR_DETAILS_RE = re.compile(
+    r"(?:Make[ \t]*[:\-][ \t]*(?P<make>[A-Za-z][A-Za-z ]*?)(?=[ \t]*(?:\n|$))"
+    r"|Model[ \t]*[:\-][ \t]*(?P<model>[^\n]+?)(?=[ \t]*(?:\n|$))"
+    r"|Year[ \t]*[:\-][ \t]*(?P<year>(?:19|20)\d{2})"
+    r"|Colou?r[ \t]*[:\-][ \t]*(?P<color>[A-Za-z ]+?)(?=[ \t]*(?:\n|$))"
+    r"|(?:License|Number)\s*Plate(?:\s*No\.?)?[ \t]*[:\-][ \t]*(?P<plate>[A-Z0-9\- ]+?)(?=[ \t]*(?:\n|$))"
+    r"|Odometer(?:\s*Reading)?[ \t]*[:\-][ \t]*(?P<odometer>[\d,]+))",
+    re.IGNORECASE
+)
+# Lessor/lessee differ by two characters — one scan finds both names.
+# The separator is mandatory so prose mentions of the parties ("the
+# Lessor agrees...") don't capture garbage that blocks the LLM fallback
+LESS_NAME_RE = re.compile(r"Less(or|ee)(?:\s*Name)?\s*[:\-]\s*([^\n]+)", re.IGNORECASE)
+# Two-stage party-address lookup: find the anchor once, then search a
+# small window after it, so no pattern ever spans the whole document
+LESSOR_ANCHOR_RE = re.compile(r"Lessor", re.IGNORECASE)
+LESSEE_ANCHOR_RE = re.compile(r"Lessee", re.IGNORECASE)
+# Separator required: "an address of ..." in prose would otherwise win
+# inside the anchor window and block the LLM fallback
+ADDRESS_FIELD_RE = re.compile(r"Address\s*[:\-]\s*([^\n]+)", re.IGNORECASE)
+# Single-anchor lease fields fused into one alternation, same single-scan
+# shape as _CAR_DETAILS_RE — the text is walked once for all five fields.
+# The separator is mandatory: an optional [:\-]? let bare "Term" match
+# inside TERMS/Termination and capture garbage, which then suppressed the
+# LLM fallback for the real value. Same for Payment/Deposit prose hits.
+_LEASE_FIELDS_RE = re.compile(
+    r"(?:Monthly\s*(?:Lease\s*)?Payment\s*[:\-]\s*(?P<monthly_payment>[^\n]+)"
+    r"|(?:Lease\s*)?Term\s*[:\-]\s*(?P<lease_term>[^\n]+)"
+    r"|(?:Start|Commencement)\s*Date\s*[:\-]\s*(?P<start_date>[^\n]+)"
+    r"|(?:Security\s*)?Deposit\s*[:\-]\s*(?P<security_deposit>[^\n]+)"
+    r"|Late\s*(?:Fee|Charge)\s*[:\-]\s*(?P<late_fee>[^\n]+))",
+    re.IGNORECASE
+)
+
+
+def _regex_search(pattern, text):
+    """Return the first captured group for a compiled pattern, or None"""
+    m = pattern.search(text)
+    return m.group(1).strip() if m else None
+
+
+def _near(anchor_re, field_re, text, window=300):
+    """Search field_re only in a small window after the first anchor hit"""
+    m = anchor_re.search(text)
+    if not m:
+        return None
+    m2 = field_re.search(text, m.end(), m.end() + window)
+    return m2.group(1).strip() if m2 else None
+
+
+def extract_vins_from_text(text):
+    """Find candidate VINs (17 chars, no I/O/Q) in the lease text"""
+    if not text:
+        return []
+    data = text.encode("latin-1", "ignore")
+    # Only the 17-char matches get uppercased, not the whole document;
+    # dict.fromkeys dedupes in C while preserving first-seen order
+    return list(dict.fromkeys(
+        v.upper().decode("ascii") for v in VIN_RE.findall(data)
+    ))
+
+
+def extract_car_details(text):
+    """Extract basic vehicle datapoints from lease text"""
+    details = {}
+
+    for m in _CAR_DETAILS_RE.finditer(text):
+        name = m.lastgroup
+        if name and name not in details:
+            value = m.group(name).strip()
+            if value:
+                details[name] = value
+
+    return details
+
+
+@lru_cache(maxsize=4096)
+def decode_vin_nhtsa(vin):
+    """Decode a VIN via the NHTSA vPIC API.
+
+    Cached by VIN — fleet batches repeat VINs and each miss is a full
+    network round-trip.
+    """
+    try:
+        response = _SESSION.get(NHTSA_DECODE_URL.format(vin=vin), timeout=TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+
+    if response.status_code != 200:
+        return None
+
+    decoded = {}
+    for item in response.json().get("Results", []):
+        variable = item.get("Variable")
+        value = item.get("Value")
+        if variable in ("Make", "Model", "Model Year", "Body Class",
+                        "Fuel Type - Primary", "Plant Country") and value:
+            decoded[variable] = value
+    return decoded or None
+
+
+def decode_vins_batch(vins):
+    """Decode many VINs via vPIC's batch endpoint, 50 per round-trip.
+
+    Returns {vin: decoded row}; VINs that fail to decode are absent.
+    Use this over per-VIN decode_vin_nhtsa when processing a fleet.
+    """
+    results = {}
+    for start in range(0, len(vins), 50):
+        batch = vins[start:start + 50]
+        try:
+            response = _SESSION.post(
+                NHTSA_BATCH_DECODE_URL,
+                data={"format": "json", "data": ";".join(batch)},
+                timeout=TIMEOUT
+            )
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code != 200:
+            continue
+        for row in response.json().get("Results", []):
+            vin = row.get("VIN")
+            if vin:
+                results[vin] = row
+    return results
+
+
+@lru_cache(maxsize=4096)
+def get_vehicle_recalls(make, model, year):
+    """Fetch open recalls for a vehicle from the NHTSA recalls API.
+
+    Cached by (make, model, year) — one lessor's contracts share the
+    same few vehicle triples.
+    """
+    try:
+        response = _SESSION.get(
+            NHTSA_RECALLS_URL,
+            params={"make": make, "model": model, "modelYear": year},
+            timeout=TIMEOUT
+        )
+    except requests.exceptions.RequestException:
+        return []
+
+    if response.status_code != 200:
+        return []
+
+    recalls = []
+    for item in response.json().get("results", []):
+        recalls.append({
+            "campaign": item.get("NHTSACampaignNumber"),
+            "component": item.get("Component"),
+            "summary": item.get("Summary")
+        })
+    return recalls
+
+
+@lru_cache(maxsize=256)
+def extract_vehicle_info(text):
+    """Extract vehicle details from lease text and enrich via NHTSA.
+
+    Cached by text so repeat uploads of the same contract don't re-hit
+    the NHTSA endpoints.
+    """
+    details = extract_car_details(text)
+
+    vins = extract_vins_from_text(text)
+    has_basics = bool(details.get("make") and details.get("model")
+                      and details.get("year"))
+
+    if vins:
+        details["vin"] = vins[0]
+        if has_basics:
+            # The recall lookup only needs make/model/year, which the
+            # regex pass already found — run both round-trips at once
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                decode_future = pool.submit(decode_vin_nhtsa, vins[0])
+                recalls_future = pool.submit(
+                    get_vehicle_recalls,
+                    details["make"], details["model"], details["year"]
+                )
+                decoded = decode_future.result()
+                details["recalls"] = recalls_future.result()
+            if decoded:
+                details["nhtsa_decode"] = decoded
+            return details
+
+        decoded = decode_vin_nhtsa(vins[0])
+        if decoded:
+            details["nhtsa_decode"] = decoded
+            # Only backfill keys the decode actually produced — a blind
+            # setdefault would plant None values in the output payload
+            for src, dst in (("Make", "make"), ("Model", "model"),
+                             ("Model Year", "year")):
+                value = decoded.get(src)
+                if value and dst not in details:
+                    details[dst] = value
+
+    if details.get("make") and details.get("model") and details.get("year"):
+        details["recalls"] = get_vehicle_recalls(
+            details["make"], details["model"], details["year"]
+        )
+
+    return details
+
+
+def extract_lessor_lessee(text):
+    """Extract lessor and lessee names in a single pass over the text"""
+    out = {"lessor": None, "lessee": None}
+    for m in LESS_NAME_RE.finditer(text):
+        key = "lessor" if m.group(1).lower() == "or" else "lessee"
+        if out[key] is None:
+            out[key] = m.group(2).strip()
+    return out
+
+
+def extract_lessor_name(text):
+    """Extract the lessor (dealer/company) name"""
+    return extract_lessor_lessee(text)["lessor"]
+
+
+def extract_lessee_name(text):
+    """Extract the lessee (customer) name"""
+    return extract_lessor_lessee(text)["lessee"]
+
+
+def _extract_json(s):
+    """Return the first parseable top-level JSON object in s, or None.
+
+    A single depth-tracking pass — the old r"\\{[\\s\\S]*\\}" search could
+    backtrack badly on long malformed replies and grabbed the widest
+    brace span rather than a balanced one.
+    """
+    depth = 0
+    start = -1
+    for i, ch in enumerate(s):
+        if ch == "{":
+            if start < 0:
+                start = i
+            depth += 1
+        elif ch == "}" and start >= 0:
+            depth -= 1
+            if depth == 0:
+                try:
+                    return json.loads(s[start:i + 1])
+                except json.JSONDecodeError:
+                    start = -1
+    return None
+
+
+def _try_mistral(prompt, want_json=False):
+    """One Mistral attempt; None on any failure"""
+    body = {
+        "model": MISTRAL_MODEL,
+        "messages": [{"role": "user", "content": prompt}]
+    }
+    if want_json:
+        body["response_format"] = {"type": "json_object"}
+    try:
+        response = _SESSION.post(
+            MISTRAL_URL,
+            headers={"Authorization": f"Bearer {MISTRAL_API_KEY}"},
+            json=body,
+            timeout=TIMEOUT
+        )
+        if response.status_code == 200:
+            return response.json()["choices"][0]["message"]["content"]
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+
+def _try_ollama(prompt, want_json=False):
+    """One local Ollama attempt; None on any failure"""
+    body = {"model": OLLAMA_MODEL, "prompt": prompt, "stream": False}
+    if want_json:
+        body["format"] = "json"
+    try:
+        response = _SESSION.post(OLLAMA_URL, json=body, timeout=TIMEOUT)
+        if response.status_code == 200:
+            return response.json().get("response", "")
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+
+# Shared across calls: a per-call `with ThreadPoolExecutor(...)` would
+# shutdown(wait=True) on exit and block the early return until the
+# losing provider finished its full generation
+_LLM_POOL = ThreadPoolExecutor(max_workers=2)
+
+
+def _call_llm(prompt, want_json=False):
+    """Ask a configured LLM — Mistral and Ollama race, first answer wins.
+
+    want_json asks the provider for a strict JSON object so one call can
+    return every field at once instead of a round-trip per field.
+    """
+    if not MISTRAL_API_KEY:
+        return _try_ollama(prompt, want_json)
+
+    # Both providers are independent; waiting out a dead Mistral before
+    # even starting Ollama made the worst case sum-of-timeouts
+    futures = [
+        _LLM_POOL.submit(_try_mistral, prompt, want_json),
+        _LLM_POOL.submit(_try_ollama, prompt, want_json),
+    ]
+    for future in as_completed(futures):
+        reply = future.result()
+        if reply:
+            # The loser keeps running in the shared pool; its helper
+            # swallows failures, so abandoning the future is safe
+            return reply
+    return None
+
+
+_FIELD_NAMES = (
+    "lessor_name", "lessor_address", "lessee_name", "lessee_address",
+    "monthly_payment", "lease_term", "start_date", "security_deposit",
+    "late_fee",
+)
+
+
+@lru_cache(maxsize=64)
+def extract_full_lease_fields(text):
+    """Extract the full set of lease fields, regex-first with LLM fallback.
+
+    Cached by text: frontend re-renders and chat turns resubmit the same
+    contract, and a miss can cost an LLM round-trip.
+    """
+    # Reject snippets and clearly non-lease text before paying for any
+    # regex scans or an LLM round-trip
+    if not text or len(text) < 200:
+        return dict.fromkeys(_FIELD_NAMES)
+    lower = text.lower()
+    if not any(tok in lower for tok in
+               ("lessor", "lessee", "lease", "vehicle identification")):
+        return dict.fromkeys(_FIELD_NAMES)
+
+    # str.__contains__ is a fast memmem scan — when the Address label
+    # never appears, skip the two bounded-span regexes outright
+    has_address = "address" in lower
+
+    names = extract_lessor_lessee(text)
+    fields = {
+        "lessor_name": names["lessor"],
+        "lessor_address": _near(LESSOR_ANCHOR_RE, ADDRESS_FIELD_RE, text) if has_address else None,
+        "lessee_name": names["lessee"],
+        "lessee_address": _near(LESSEE_ANCHOR_RE, ADDRESS_FIELD_RE, text) if has_address else None,
+        "monthly_payment": None,
+        "lease_term": None,
+        "start_date": None,
+        "security_deposit": None,
+        "late_fee": None,
+    }
+
+    for m in _LEASE_FIELDS_RE.finditer(text):
+        name = m.lastgroup
+        if name and fields[name] is None:
+            fields[name] = m.group(name).strip()
+
+    missing = [k for k, v in fields.items() if not v]
+    if missing:
+        prompt = (
+            "Extract the following fields from this car lease contract and "
+            "respond with ONLY a JSON object: "
+            + ", ".join(missing)
+            + "\n\nContract:\n" + text[:4000]
+        )
+        reply = _call_llm(prompt, want_json=True)
+        if reply:
+            parsed = _extract_json(reply)
+            if parsed:
+                for k in missing:
+                    if parsed.get(k):
+                        fields[k] = parsed[k]
+
+    return fields